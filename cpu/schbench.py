@@ -22,6 +22,13 @@ from avocado.utils import process
 from avocado.utils import build, distro, git
 from avocado.utils.software_manager.manager import SoftwareManager
 
+# byte patterns: schbench output is plain ASCII, so the parsers work on
+# res.stdout/res.stderr directly and decode only the captured fields
+_TRANSFER_RE = re.compile(rb'transfer: (.*?) ops/sec (.*?)MB/s')
+_TOTAL_SAMPLES_RE = re.compile(rb'\(s\) \((.*?) total samples\)')
+_PERCENTILE_RE = re.compile(rb'\*?\s*([\d.]+)th: (\d+) \((\d+) samples\)')
+_PERF_RE = re.compile(rb'([\d,.]+)\s+([^#]+?)\s+#\s*([\d,.]+)\s*(.*)')
+
 
 class Schbench(Test):
 
@@ -32,38 +39,104 @@ class Schbench(Test):
     :avocado: tags=cpu
     '''
 
+    # dependency resolution is identical for every variant, so do it
+    # only once per avocado process
+    _deps_done = False
+
     def setUp(self):
         '''
         Build schbench
         Source:
         https://git.kernel.org/pub/scm/linux/kernel/git/mason/schbench.git
         '''
-        sm = SoftwareManager()
-        distro_name = distro.detect().name
-        deps = ['gcc', 'make']
-        if 'Ubuntu' in distro_name:
-            deps.extend(['linux-tools-common', 'linux-tools-%s' %
-                         platform.uname()[2]])
-        elif distro_name in ['rhel', 'SuSE', 'fedora', 'centos']:
-            deps.extend(['perf'])
-        else:
-            self.cancel("Install the package for perf supported \
-                         by %s" % distro_name)
-
-        for package in deps:
-            if not sm.check_installed(package) and not sm.install(package):
-                self.cancel("%s is needed for the test to be run" % package)
+        if not Schbench._deps_done:
+            sm = SoftwareManager()
+            distro_name = distro.detect().name
+            deps = ['gcc', 'make']
+            if 'Ubuntu' in distro_name:
+                kernel = platform.release()
+                deps.extend(['linux-tools-common', 'linux-tools-%s' % kernel])
+            elif distro_name in ['rhel', 'SuSE', 'fedora', 'centos']:
+                deps.extend(['perf'])
+            else:
+                self.cancel("Install the package for perf supported \
+                             by %s" % distro_name)
+
+            missing = [package for package in deps
+                       if not sm.check_installed(package)]
+            if missing and not sm.install(' '.join(missing)):
+                self.cancel("%s is needed for the test to be run"
+                            % ' '.join(missing))
+            Schbench._deps_done = True
         url = 'https://git.kernel.org/pub/scm/linux/kernel/git/mason/schbench.git'
         schbench_url = self.params.get("schbench_url", default=url)
-        git.get_repo(schbench_url, destination_dir=self.workdir)
+        if not os.path.isfile(os.path.join(self.workdir, 'schbench')):
+            git.get_repo(schbench_url, destination_dir=self.workdir)
+            build.make(self.workdir)
 
-        os.chdir(self.workdir)
-        build.make(self.workdir)
+    def parse_schbench_data(self, lines, perf_requested=False):
+        '''
+        Walk the schbench stderr lines once, picking up the total sample
+        count from the report header, the latency percentiles that
+        follow it and, when the run was wrapped in 'perf stat', the
+        counter values printed after the benchmark output. Returns
+        everything as a single dict.
+        '''
+        records = {}
+        perf_stats = {}
+        in_block = False
+        in_perf_stats = False
+        parsed = 0
+        for line in lines:
+            if in_perf_stats:
+                # counter lines always carry a '#' comment; anything
+                # else (blanks, elapsed-time footer) can be skipped
+                # without entering the regex engine
+                if b'#' not in line:
+                    continue
+                match = _PERF_RE.match(line.strip())
+                if match:
+                    value, event, metric_value, metric = match.groups()
+                    perf_stats[event.strip().decode()] = {
+                        'value': value.decode(),
+                        'metric_value': metric_value.decode(),
+                        'metric': metric.strip().decode() if metric else ''}
+                continue
+            if not in_block:
+                if line.startswith(b'Latency percentiles'):
+                    in_block = True
+                    records['total_samples'] = _TOTAL_SAMPLES_RE.search(
+                        line).group(1).decode()
+                continue
+            if perf_requested and b'Performance counter stats' in line:
+                in_perf_stats = True
+                continue
+            # substring check is far cheaper than entering the regex
+            # engine, so weed out non-percentile lines first
+            if b'th:' not in line:
+                continue
+            match = _PERCENTILE_RE.match(line.strip())
+            if not match:
+                continue
+            key = match.group(1).decode()
+            records[key] = match.group(2).decode()
+            records['samples_%s' % key] = match.group(3).decode()
+            parsed += 1
+            # gather logs till 99.9th percentile; keep going when the
+            # perf stat section is still to come
+            if parsed == 7 and not perf_requested:
+                break
+        if perf_stats:
+            records['perf_stats'] = perf_stats
+        return records
 
     def test(self):
 
         perfstat = self.params.get('perfstat', default='')
-        if perfstat:
+        # remember whether perf was asked for before perfstat is turned
+        # into the command prefix below
+        perf_requested = bool(perfstat)
+        if perf_requested:
             perfstat = 'perf stat ' + perfstat
         taskset = self.params.get('taskset', default='')
         if taskset:
@@ -74,50 +147,33 @@ class Schbench(Test):
         runtime = self.params.get('runtime', default=100)
         cputime = self.params.get('cputime', default=10000)
         autobench = self.params.get('autobench', default=False)
-        args = '-m %s -t %s -p %s -r %s -s %s ' % (num_threads, num_workers,
-                                                   bytes, runtime, cputime)
+        args = (f'-m {num_threads} -t {num_workers} -p {bytes} '
+                f'-r {runtime} -s {cputime} ')
 
         if autobench:
             args += '-a'
 
         cmd = "%s %s %s/schbench %s" % (perfstat, taskset, self.workdir, args)
-        res = process.run(cmd, ignore_status=True, shell=True)
+        res = process.run(cmd, ignore_status=True)
         if res.exit_status:
             self.fail("The test failed. Failed command is %s" % cmd)
 
         records = {'runtime': runtime}
-        lines = res.stdout.decode().splitlines()
-        pattern = re.compile(r'transfer: (.*?) ops/sec (.*?)MB/s')
-        avg_rec = pattern.findall(lines[0])[0]
-        records['ops'] = avg_rec[0]
-        records['ops_rate'] = avg_rec[1]
-
-        parsed_lines = []
-        count = 0
-        erlines = res.stderr.decode().splitlines()
-        for line in erlines:
-            if count:
-                parsed_lines.append(line)
-                count += 1
-                # gather logs till 99.9th percentile
-                if count == 8:
-                    break
-                continue
-            if line.startswith('Latency percentiles'):
-                count = 1
-                parsed_lines.append(line)
-        pattern = re.compile(r'\(s\) \((.*?) total samples\)')
-        records['total_samples'] = pattern.findall(parsed_lines[0])[0]
-        parsed_lines = parsed_lines[1:]
-
-        pattern = re.compile(r'(.*?)th: (.*?) \((.*?) samples\)')
-        for line in parsed_lines:
-            values = pattern.findall(line)[0]
-            key = values[0].replace('\t', '')
-            records[key] = values[1]
-            records['samples_%s' % key] = values[2]
-
-        json_object = json.dumps(records)
+        lines = res.stdout.splitlines()
+        avg_rec = _TRANSFER_RE.search(lines[0])
+        records['ops'] = avg_rec.group(1).decode()
+        records['ops_rate'] = avg_rec.group(2).decode()
+
+        # schbench prints a percentile report per interval and only the
+        # last block covers the whole run; a single memchr-backed rfind
+        # on the raw bytes finds it, so only the interesting tail gets
+        # split into lines
+        raw = res.stderr
+        idx = raw.rfind(b'Latency percentiles')
+        tail = raw[idx:] if idx >= 0 else raw
+        records.update(self.parse_schbench_data(tail.splitlines(),
+                                                perf_requested))
+
         logfile = os.path.join(self.logdir, "schbench.json")
-        with open(logfile, "w") as outfile:
-            outfile.write(json_object)
+        with open(logfile, "w", buffering=65536) as outfile:
+            json.dump(records, outfile, separators=(',', ':'))